@@ -24,13 +24,17 @@ Autor: Refactorizado 2026
 Versión: 2.0.0
 """
 
-from datetime import datetime, timezone
-from typing import Optional, Dict, Any, List
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, tzinfo
+from typing import Optional, Dict, Any, List, Tuple, Callable, NamedTuple
+from dataclasses import dataclass, field
 from enum import Enum
+import functools
 import logging
 import re
 import os
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 import boto3
 from botocore.exceptions import ClientError
@@ -57,6 +61,46 @@ class TagNames:
     LEGACY_STOP = "stopInstance"
 
 
+# Tags que se leen de cada instancia; el resto (owner, cost-center...) se ignora
+_WANTED_TAGS = frozenset({
+    TagNames.SCHEDULE_ENABLED,
+    TagNames.START_TIME,
+    TagNames.STOP_TIME,
+    TagNames.DAYS,
+    TagNames.TIMEZONE,
+    TagNames.LEGACY_START,
+    TagNames.LEGACY_STOP,
+    'Name',
+})
+
+# Tags que identifican una instancia como candidata a schedule. La API de
+# tagging combina los filtros con AND, así que se consulta cada clave por separado
+SCHEDULE_TAG_KEYS = (
+    TagNames.SCHEDULE_ENABLED,
+    TagNames.LEGACY_START,
+    TagNames.LEGACY_STOP,
+)
+
+# Máximo de instancias por llamada a StartInstances/StopInstances
+ACTION_BATCH_SIZE = 200
+
+# Errores de Start/StopInstances causados por una instancia concreta del lote.
+# Solo con estos tiene sentido reintentar instancia a instancia; el resto
+# (throttling, permisos...) afectaría igual a cada reintento
+_PER_INSTANCE_ERROR_CODES = frozenset({
+    'IncorrectInstanceState',
+    'InvalidInstanceID.NotFound',
+    'InvalidInstanceID.Malformed',
+    'UnsupportedOperation',
+})
+
+# Hilos para enviar lotes en paralelo (las llamadas a la API liberan el GIL)
+MAX_WORKERS = 32
+
+# Expresiones regulares compiladas una sola vez al importar el módulo
+_SIMPLE_TIME_RE = re.compile(r"^(\d{1,2}):(\d{2})$")
+
+
 class InstanceAction(Enum):
     """Acciones posibles sobre una instancia."""
     START = "start"
@@ -64,9 +108,15 @@ class InstanceAction(Enum):
     NONE = "none"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ScheduleConfig:
-    """Configuración de horario para una instancia EC2."""
+    """
+    Configuración de horario para una instancia EC2.
+    
+    Es inmutable para poder compartir la misma instancia entre todas las
+    máquinas con las mismas tags de schedule (ver _config_from_relevant_tags)
+    y usarla como clave al agrupar. Usa __slots__ en lugar de __dict__.
+    """
     enabled: bool = False
     start_time: Optional[str] = None
     stop_time: Optional[str] = None
@@ -76,13 +126,115 @@ class ScheduleConfig:
     # Soporte legacy
     legacy_start_cron: Optional[str] = None
     legacy_stop_cron: Optional[str] = None
+    
+    # Comprobaciones de horario especializadas para esta configuración
+    _start_matcher: Callable[[datetime], bool] = field(init=False, repr=False, compare=False)
+    _stop_matcher: Callable[[datetime], bool] = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        # Se construyen una sola vez por configuración; al ser frozen hay que
+        # asignarlas con object.__setattr__
+        object.__setattr__(self, '_start_matcher',
+                           _build_matcher(self.start_time, self.legacy_start_cron, self.days))
+        object.__setattr__(self, '_stop_matcher',
+                           _build_matcher(self.stop_time, self.legacy_stop_cron, self.days))
+
+
+class InstanceInfo(NamedTuple):
+    """Instancia a la que aplicar una acción: ID y valor de la tag Name."""
+    instance_id: str
+    name: str = ""
+    
+    @property
+    def display_name(self) -> str:
+        """Nombre legible de la instancia para los logs."""
+        return f"{self.name} ({self.instance_id})" if self.name else self.instance_id
+
+
+# Máscara de "*": todos los bits activos (en Python, -1 se comporta como
+# una secuencia infinita de unos)
+_ALL_UNITS = -1
+
+# Mayor unidad representable en la máscara. Ningún campo cron pasa de 59,
+# así que valores mayores nunca coinciden y no se reservan bits para ellos
+_MAX_UNIT = 63
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_cron_field(range_str: str) -> Optional[int]:
+    """
+    Parsea un campo cron a una máscara de bits con un único recorrido.
+    
+    Formatos aceptados: "*", "5", "1-5" y "1,3,5" (sin mezclar "-" y ",").
+    El bit i está activo si la unidad i coincide, así que la comprobación
+    es (mask >> unit) & 1; por ejemplo "1-5" -> 0b111110.
+    
+    Args:
+        range_str: Campo cron ya sin espacios alrededor
+        
+    Returns:
+        Máscara de bits (_ALL_UNITS para "*") o None si el formato es inválido
+    """
+    if range_str == "*":
+        return _ALL_UNITS
+    
+    values = []
+    separator = None
+    current = -1  # -1: aún no hay dígitos en el número actual
+    
+    for char in range_str:
+        if "0" <= char <= "9":
+            current = (current * 10 if current >= 0 else 0) + ord(char) - 48
+        elif char in "-," and current >= 0:
+            # Un solo tipo de separador, y "-" como mucho una vez
+            if separator is not None and (char != separator or char == "-"):
+                return None
+            separator = char
+            values.append(current)
+            current = -1
+        else:
+            return None
+    
+    if current < 0:
+        return None
+    values.append(current)
+    
+    if separator == "-":
+        start, end = values[0], min(values[1], _MAX_UNIT)
+        if start > end:
+            return 0
+        return ((1 << (end - start + 1)) - 1) << start
+    
+    mask = 0
+    for value in values:
+        if value <= _MAX_UNIT:
+            mask |= 1 << value
+    return mask
+
+
+def _never(now: datetime) -> bool:
+    """Matcher para configuraciones sin horario (o con horario inválido)."""
+    return False
+
+
+def _mask_matches(mask: int, unit: int) -> bool:
+    """Indica si la unidad de tiempo está incluida en la máscara de un campo cron."""
+    # Unidades negativas: solo el wildcard las acepta
+    if unit < 0:
+        return mask == _ALL_UNITS
+    return (mask >> unit) & 1 == 1
+
+
+def _field_predicate(mask: int) -> Callable[[int], bool]:
+    """Convierte la máscara de un campo cron en un predicado sobre la unidad de tiempo."""
+    if mask == _ALL_UNITS:
+        return lambda unit: True
+    return functools.partial(_mask_matches, mask)
 
 
 class CronMatcher:
     """Clase para validar y comparar expresiones cron con el tiempo actual."""
     
-    CRON_PATTERN = re.compile(r"^[0-9]+-[0-9]+$|^[0-9]+(,[0-9]+)*$|\*$")
-    
     @staticmethod
     def match_unit(unit: int, range_str: str) -> bool:
         """
@@ -98,38 +250,48 @@ class CronMatcher:
         if not isinstance(range_str, str) or not isinstance(unit, int):
             return False
         
-        range_str = range_str.strip()
+        mask = _parse_cron_field(range_str.strip())
         
-        # Wildcard: acepta todo
-        if range_str == "*":
-            return True
-        
-        # Validar formato
-        if not CronMatcher.CRON_PATTERN.match(range_str):
+        if mask is None:
             logger.warning(f"Expresión cron inválida: {range_str}")
             return False
         
-        # Valor exacto
-        if range_str.isdigit():
-            return unit == int(range_str)
-        
-        # Rango (ej: "1-5")
-        if "-" in range_str and "," not in range_str:
-            try:
-                start, end = map(int, range_str.split("-"))
-                return start <= unit <= end
-            except ValueError:
-                return False
+        return _mask_matches(mask, unit)
+    
+    @classmethod
+    def build_matcher(cls, cron_string: str) -> Callable[[datetime], bool]:
+        """
+        Especializa una expresión cron en una función matcher(now) -> bool.
         
-        # Enumeración (ej: "1,3,5")
-        if "," in range_str:
-            try:
-                values = [int(v.strip()) for v in range_str.split(",")]
-                return unit in values
-            except ValueError:
-                return False
+        Los campos se parsean una sola vez, así que evaluar el matcher no
+        vuelve a recorrer la expresión.
         
-        return False
+        Args:
+            cron_string: Expresión cron "minuto hora día mes día_semana"
+            
+        Returns:
+            Función que indica si un momento coincide con la expresión
+        """
+        parts = cron_string.strip().split()
+        if len(parts) != 5:
+            logger.warning(f"Expresión cron debe tener 5 campos: {cron_string}")
+            return _never
+        
+        fields = [_parse_cron_field(part) for part in parts]
+        if None in fields:
+            logger.warning(f"Expresión cron inválida: {cron_string}")
+            return _never
+        
+        minute, hour, day, month, weekday = map(_field_predicate, fields)
+        
+        # Cortocircuito, ordenado por probabilidad de descartar
+        return lambda now: (
+            minute(now.minute)
+            and weekday(now.isoweekday())
+            and hour(now.hour)
+            and day(now.day)
+            and month(now.month)
+        )
     
     @classmethod
     def is_time_match(cls, cron_string: str, now: datetime) -> bool:
@@ -151,15 +313,15 @@ class CronMatcher:
             
             minute, hour, day, month, weekday = parts
             
-            checks = [
-                cls.match_unit(now.minute, minute),
-                cls.match_unit(now.hour, hour),
-                cls.match_unit(now.day, day),
-                cls.match_unit(now.month, month),
-                cls.match_unit(now.isoweekday(), weekday),
-            ]
-            
-            return all(checks)
+            # Cortocircuito sin construir el matcher, en el mismo orden que
+            # build_matcher: primero los campos que más descartan
+            return (
+                cls.match_unit(now.minute, minute)
+                and cls.match_unit(now.isoweekday(), weekday)
+                and cls.match_unit(now.hour, hour)
+                and cls.match_unit(now.day, day)
+                and cls.match_unit(now.month, month)
+            )
             
         except Exception as e:
             logger.error(f"Error evaluando expresión cron '{cron_string}': {e}")
@@ -169,7 +331,7 @@ class CronMatcher:
 class TimeParser:
     """Utilidades para parsear diferentes formatos de tiempo."""
     
-    SIMPLE_TIME_PATTERN = re.compile(r"^(\d{1,2}):(\d{2})$")
+    SIMPLE_TIME_PATTERN = _SIMPLE_TIME_RE
     
     @classmethod
     def parse_simple_time(cls, time_str: str) -> Optional[tuple]:
@@ -182,7 +344,7 @@ class TimeParser:
         Returns:
             Tuple (hora, minuto) o None si el formato es inválido
         """
-        match = cls.SIMPLE_TIME_PATTERN.match(time_str.strip())
+        match = _SIMPLE_TIME_RE.match(time_str.strip())
         if match:
             hour, minute = int(match.group(1)), int(match.group(2))
             if 0 <= hour <= 23 and 0 <= minute <= 59:
@@ -202,26 +364,51 @@ class TimeParser:
         Returns:
             True si coincide la hora (y el día si se especifica)
         """
+        # Camino rápido para "H:MM"/"HH:MM": se compara la hora antes de
+        # cualquier parseo, que es lo que descarta en casi todas las llamadas
+        if 4 <= len(time_str) <= 5 and time_str[-3] == ":" and time_str[:-3].isdecimal():
+            if int(time_str[:-3]) != now.hour:
+                return False
+            minute_str = time_str[-2:]
+            if not (minute_str.isdecimal() and int(minute_str) <= 59):
+                return False
+        else:
+            parsed = cls.parse_simple_time(time_str)
+            if parsed is None or parsed[0] != now.hour:
+                return False
+        
+        return days == "*" or CronMatcher.match_unit(now.isoweekday(), days)
+    
+    @classmethod
+    def build_simple_time_matcher(cls, time_str: str, days: str = "*") -> Callable[[datetime], bool]:
+        """
+        Especializa un tiempo "HH:MM" (y sus días) en una función matcher(now) -> bool.
+        
+        Args:
+            time_str: Tiempo en formato "HH:MM"
+            days: Días de la semana válidos
+            
+        Returns:
+            Función que indica si coincide la hora (y el día si se especifica).
+            El minuto solo se valida: la Lambda puede ejecutarse en cualquier
+            minuto de la hora y aún así detectar la hora correcta
+        """
         parsed = cls.parse_simple_time(time_str)
         if not parsed:
-            return False
-        
-        hour, minute = parsed
+            return _never
         
-        # Verificar hora
-        if now.hour != hour:
-            return False
+        hour = parsed[0]
         
-        # Verificar minuto (con tolerancia de ±5 minutos para ejecuciones cada hora)
-        # Esto permite que la Lambda se ejecute en cualquier minuto de la hora
-        # y aún así detecte la hora correcta
+        if days == "*":
+            return lambda now: now.hour == hour
         
-        # Verificar día de la semana
-        if days != "*":
-            if not CronMatcher.match_unit(now.isoweekday(), days):
-                return False
+        days_mask = _parse_cron_field(days.strip())
+        if days_mask is None:
+            logger.warning(f"Expresión cron inválida: {days}")
+            return _never
         
-        return True
+        # La hora primero: con ejecuciones cada hora es la que más descarta
+        return lambda now: now.hour == hour and (days_mask >> now.isoweekday()) & 1 == 1
     
     @classmethod
     def is_cron_expression(cls, value: str) -> bool:
@@ -229,77 +416,158 @@ class TimeParser:
         return len(value.strip().split()) == 5
 
 
+def _build_matcher(time_value: Optional[str], legacy_cron: Optional[str],
+                   days: str) -> Callable[[datetime], bool]:
+    """
+    Construye el matcher de una acción a partir de sus tags.
+    
+    Aplica la misma prioridad que antes evaluaba should_perform_action: primero
+    el formato nuevo (simple o cron) y después las tags legacy.
+    """
+    if time_value:
+        if TimeParser.is_cron_expression(time_value):
+            return CronMatcher.build_matcher(time_value)
+        return TimeParser.build_simple_time_matcher(time_value, days)
+    
+    if legacy_cron:
+        return CronMatcher.build_matcher(legacy_cron)
+    
+    return _never
+
+
+@functools.lru_cache(maxsize=64)
+def _zi(tz_name: str) -> tzinfo:
+    """
+    Devuelve (y cachea) la zona horaria IANA indicada.
+    
+    Si la zona no existe o no se puede cargar se usa UTC, igual que antes con
+    zonas desconocidas. OSError cubre claves que apuntan a un directorio del
+    paquete tzdata (ej: "Europe"), que lanzan IsADirectoryError.
+    """
+    try:
+        return ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError, OSError) as e:
+        logger.warning(f"Error con zona horaria {tz_name}: {e}. Usando UTC.")
+        return timezone.utc
+
+
 def get_current_time(tz_name: str = "UTC") -> datetime:
     """
     Obtiene la hora actual en la zona horaria especificada.
     
+    Usa la base de datos IANA (zoneinfo), por lo que respeta el horario de verano.
+    
     Args:
         tz_name: Nombre de la zona horaria (ej: "Europe/Madrid")
         
     Returns:
         datetime con la hora actual
     """
-    try:
-        # Para zonas horarias avanzadas, se necesitaría pytz o zoneinfo (Python 3.9+)
-        # Por simplicidad, usamos UTC y ajustamos manualmente las más comunes
-        from datetime import timedelta
-        
-        now_utc = datetime.now(timezone.utc)
-        
-        # Mapa simple de zonas horarias comunes
-        tz_offsets = {
-            "UTC": 0,
-            "Europe/Madrid": 1,  # CET (sin horario de verano)
-            "Europe/London": 0,
-            "America/New_York": -5,
-            "America/Los_Angeles": -8,
-            "Asia/Tokyo": 9,
-        }
-        
-        offset = tz_offsets.get(tz_name, 0)
-        return now_utc + timedelta(hours=offset)
-        
-    except Exception as e:
-        logger.warning(f"Error con zona horaria {tz_name}: {e}. Usando UTC.")
-        return datetime.now(timezone.utc)
+    return datetime.now(_zi(tz_name))
+
+
+@functools.lru_cache(maxsize=1024)
+def _config_from_relevant_tags(schedule: str, start: Optional[str], stop: Optional[str],
+                               days: str, tz: str, legacy_start: Optional[str],
+                               legacy_stop: Optional[str]) -> ScheduleConfig:
+    """
+    Construye (y memoriza) la configuración a partir de los valores de las tags.
+    
+    Las flotas suelen compartir los mismos horarios, así que instancias con
+    las mismas tags de schedule reciben el mismo objeto ScheduleConfig.
+    """
+    # Si hay tags legacy, considerar habilitado
+    enabled = schedule.lower() == "enabled" or bool(legacy_start or legacy_stop)
+    
+    return ScheduleConfig(
+        enabled=enabled,
+        start_time=start,
+        stop_time=stop,
+        days=days,
+        timezone=tz,
+        legacy_start_cron=legacy_start,
+        legacy_stop_cron=legacy_stop,
+    )
+
+
+def _relevant_tags(tags: Optional[List[Dict[str, str]]]) -> Dict[str, str]:
+    """
+    Recorre las tags una sola vez y devuelve solo las de _WANTED_TAGS.
+    
+    Incluye la tag Name, de modo que no hace falta un segundo recorrido para
+    obtener el nombre de la instancia.
+    """
+    relevant = {}
+    for tag in tags or ():
+        key = tag['Key']
+        if key in _WANTED_TAGS:
+            relevant[key] = tag['Value']
+    return relevant
+
+
+def _config_from_relevant(relevant: Dict[str, str]) -> ScheduleConfig:
+    """Obtiene la configuración (memorizada) a partir del resultado de _relevant_tags."""
+    get = relevant.get
+    return _config_from_relevant_tags(
+        get(TagNames.SCHEDULE_ENABLED, ""),
+        get(TagNames.START_TIME),
+        get(TagNames.STOP_TIME),
+        get(TagNames.DAYS, "*"),
+        get(TagNames.TIMEZONE, DEFAULT_TIMEZONE),
+        get(TagNames.LEGACY_START),
+        get(TagNames.LEGACY_STOP),
+    )
 
 
-def extract_schedule_config(instance) -> ScheduleConfig:
+def extract_schedule_config(tags: Optional[List[Dict[str, str]]]) -> ScheduleConfig:
     """
     Extrae la configuración de horario de las tags de una instancia.
     
     Args:
-        instance: Instancia EC2 de boto3
+        tags: Lista de tags tal como la devuelve la API, [{'Key': ..., 'Value': ...}]
         
     Returns:
         ScheduleConfig con la configuración encontrada
     """
-    config = ScheduleConfig()
-    
-    if not instance.tags:
-        return config
-    
-    tags = {tag['Key']: tag['Value'] for tag in instance.tags}
+    if not tags:
+        return ScheduleConfig()
     
-    # Verificar si el schedule está habilitado
-    schedule_value = tags.get(TagNames.SCHEDULE_ENABLED, "").lower()
-    config.enabled = schedule_value == "enabled"
-    
-    # Obtener configuración de horarios
-    config.start_time = tags.get(TagNames.START_TIME)
-    config.stop_time = tags.get(TagNames.STOP_TIME)
-    config.days = tags.get(TagNames.DAYS, "*")
-    config.timezone = tags.get(TagNames.TIMEZONE, DEFAULT_TIMEZONE)
-    
-    # Soporte para tags legacy
-    config.legacy_start_cron = tags.get(TagNames.LEGACY_START)
-    config.legacy_stop_cron = tags.get(TagNames.LEGACY_STOP)
+    return _config_from_relevant(_relevant_tags(tags))
+
+
+def _instance_id_from_arn(arn: str) -> str:
+    """Extrae el ID de instancia de un ARN (arn:aws:ec2:region:cuenta:instance/i-...)."""
+    return arn.rsplit("/", 1)[-1]
+
+
+def discover_scheduled_instances(tagging_client) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Obtiene las instancias EC2 con tags de schedule mediante la API de tagging.
     
-    # Si hay tags legacy, considerar habilitado
-    if config.legacy_start_cron or config.legacy_stop_cron:
-        config.enabled = True
+    Cada clave de SCHEDULE_TAG_KEYS se consulta por separado y los resultados
+    se combinan por ID de instancia. La respuesta ya incluye las tags, por lo que
+    no es necesario describir las instancias para evaluar su configuración.
     
-    return config
+    Args:
+        tagging_client: Cliente boto3 de 'resourcegroupstaggingapi'
+        
+    Returns:
+        Diccionario {instance_id: tags}
+    """
+    instances = {}
+    paginator = tagging_client.get_paginator('get_resources')
+    
+    for tag_key in SCHEDULE_TAG_KEYS:
+        pages = paginator.paginate(
+            TagFilters=[{'Key': tag_key}],
+            ResourceTypeFilters=['ec2:instance'],
+        )
+        for page in pages:
+            for resource in page.get('ResourceTagMappingList', []):
+                instance_id = _instance_id_from_arn(resource['ResourceARN'])
+                instances[instance_id] = resource.get('Tags', [])
+    
+    return instances
 
 
 def should_perform_action(config: ScheduleConfig, action: InstanceAction, now: datetime) -> bool:
@@ -314,82 +582,103 @@ def should_perform_action(config: ScheduleConfig, action: InstanceAction, now: d
     Returns:
         True si se debe realizar la acción
     """
+    # Los matchers se especializan al crear la configuración (ver _build_matcher)
     if action == InstanceAction.START:
-        time_value = config.start_time
-        legacy_cron = config.legacy_start_cron
-    elif action == InstanceAction.STOP:
-        time_value = config.stop_time
-        legacy_cron = config.legacy_stop_cron
-    else:
-        return False
-    
-    # Primero intentar con el nuevo formato simple
-    if time_value:
-        if TimeParser.is_cron_expression(time_value):
-            return CronMatcher.is_time_match(time_value, now)
-        else:
-            return TimeParser.is_simple_time_match(time_value, now, config.days)
-    
-    # Fallback a formato legacy
-    if legacy_cron:
-        return CronMatcher.is_time_match(legacy_cron, now)
-    
+        return config._start_matcher(now)
+    if action == InstanceAction.STOP:
+        return config._stop_matcher(now)
     return False
 
 
-def execute_instance_action(instance, action: InstanceAction) -> bool:
+def execute_batch_action(ec2_client, action: InstanceAction,
+                         instances: List[InstanceInfo]) -> Tuple[List[str], List[Dict[str, str]]]:
     """
-    Ejecuta una acción sobre una instancia EC2.
+    Ejecuta una acción sobre un lote de instancias EC2 con una sola llamada.
+    
+    No se consulta el estado previo: StartInstances sobre una instancia en
+    marcha y StopInstances sobre una detenida no tienen efecto, y el estado
+    anterior se obtiene de PreviousState en la respuesta. Si un lote falla
+    por culpa de una instancia concreta (ej: una instancia terminada), se
+    divide en mitades hasta aislarla, con O(k·log n) llamadas para k instancias
+    problemáticas, para no bloquear al resto; cualquier otro
+    error (throttling, permisos...) marca el lote entero como fallido.
+    
+    No modifica estado compartido, así que puede ejecutarse desde varios hilos
+    con el mismo cliente EC2.
     
     Args:
-        instance: Instancia EC2
-        action: Acción a realizar
+        ec2_client: Cliente EC2 de boto3
+        action: Acción a realizar (START o STOP)
+        instances: Lote de instancias (como mucho ACTION_BATCH_SIZE)
         
     Returns:
-        True si la acción se ejecutó correctamente
+        Tuple (IDs cuyo estado ha cambiado, errores)
     """
-    instance_id = instance.id
-    instance_name = ""
-    
-    # Obtener nombre de la instancia
-    if instance.tags:
-        for tag in instance.tags:
-            if tag['Key'] == 'Name':
-                instance_name = tag['Value']
-                break
+    if action == InstanceAction.START:
+        operation, response_key, emoji, verb = ec2_client.start_instances, 'StartingInstances', "🟢", "Iniciando"
+        already = ("pending", "running")
+    elif action == InstanceAction.STOP:
+        operation, response_key, emoji, verb = ec2_client.stop_instances, 'StoppingInstances', "🔴", "Deteniendo"
+        already = ("stopping", "stopped")
+    else:
+        return [], []
     
-    display_name = f"{instance_name} ({instance_id})" if instance_name else instance_id
+    done = []
+    errors = []
+    # Empieza con el lote completo; si falla por una instancia se divide en
+    # mitades y solo las mitades que vuelven a fallar se siguen dividiendo
+    batches = deque([instances])
     
-    try:
-        if action == InstanceAction.START:
-            if instance.state["Name"] == "stopped":
-                logger.info(f"🟢 Iniciando instancia: {display_name}")
-                instance.start()
-                return True
-            else:
-                logger.debug(f"Instancia {display_name} no está detenida (estado: {instance.state['Name']})")
-                
-        elif action == InstanceAction.STOP:
-            if instance.state["Name"] == "running":
-                logger.info(f"🔴 Deteniendo instancia: {display_name}")
-                instance.stop()
-                return True
-            else:
-                logger.debug(f"Instancia {display_name} no está corriendo (estado: {instance.state['Name']})")
-                
-    except ClientError as e:
-        logger.error(f"Error al ejecutar {action.value} en {display_name}: {e}")
-        return False
+    while batches:
+        batch = batches.popleft()
+        
+        try:
+            response = operation(InstanceIds=[instance.instance_id for instance in batch])
+        except ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code')
+            if len(batch) > 1 and error_code in _PER_INSTANCE_ERROR_CODES:
+                logger.warning(f"Error al ejecutar {action.value} en lote de {len(batch)} instancias: {e}. Reintentando en dos mitades.")
+                middle = len(batch) // 2
+                batches.extend((batch[:middle], batch[middle:]))
+                continue
+            
+            logger.error(f"Error al ejecutar {action.value} en {', '.join(i.display_name for i in batch)}: {e}")
+            errors.extend(
+                {"instance_id": instance.instance_id, "action": action.value, "error": str(e)}
+                for instance in batch
+            )
+            continue
+        
+        by_id = {instance.instance_id: instance for instance in batch}
+        
+        for item in response.get(response_key, []):
+            instance_id = item['InstanceId']
+            previous = item.get('PreviousState', {}).get('Name')
+            display_name = by_id.get(instance_id, InstanceInfo(instance_id)).display_name
+            
+            if previous in already:
+                logger.debug(f"Instancia {display_name} ya estaba en estado {previous}")
+                continue
+            
+            logger.info(f"{emoji} {verb} instancia: {display_name}")
+            done.append(instance_id)
     
-    return False
+    return done, errors
 
 
-def process_instances(ec2_resource) -> Dict[str, Any]:
+def process_instances(ec2_client, tagging_client, now_utc: Optional[datetime] = None) -> Dict[str, Any]:
     """
-    Procesa todas las instancias EC2 y ejecuta las acciones correspondientes.
+    Procesa las instancias EC2 con tags de schedule y ejecuta las acciones correspondientes.
+    
+    El descubrimiento se hace con la API de tagging, que devuelve las tags de
+    cada instancia directamente. Las acciones se envían con llamadas
+    StartInstances/StopInstances en lote, en paralelo, sin describir antes
+    las instancias (ambas operaciones son idempotentes).
     
     Args:
-        ec2_resource: Recurso EC2 de boto3
+        ec2_client: Cliente EC2 de boto3
+        tagging_client: Cliente boto3 de 'resourcegroupstaggingapi'
+        now_utc: Instante de referencia en UTC (por defecto, el actual)
         
     Returns:
         Diccionario con estadísticas de la ejecución
@@ -402,38 +691,119 @@ def process_instances(ec2_resource) -> Dict[str, Any]:
         "errors": [],
     }
     
-    for instance in ec2_resource.instances.all():
-        stats["total_instances"] += 1
-        
-        config = extract_schedule_config(instance)
+    candidates = discover_scheduled_instances(tagging_client)
+    stats["total_instances"] = len(candidates)
+    
+    # Todas las instancias se evalúan en el mismo instante; solo cambia la zona
+    # horaria, así que la hora local se calcula una vez por zona
+    if now_utc is None:
+        now_utc = datetime.now(timezone.utc)
+    local_now: Dict[str, datetime] = {}
+    
+    # Agrupar por configuración: instancias con el mismo horario comparten
+    # el mismo ScheduleConfig (inmutable y hashable)
+    groups: Dict[ScheduleConfig, List[InstanceInfo]] = {}
+    
+    for instance_id, tags in candidates.items():
+        relevant = _relevant_tags(tags)
+        config = _config_from_relevant(relevant)
         
         if not config.enabled:
             continue
         
         stats["scheduled_instances"] += 1
-        
-        # Obtener hora actual en la zona horaria configurada
-        now = get_current_time(config.timezone)
-        
-        instance_id = instance.id
+        groups.setdefault(config, []).append(InstanceInfo(instance_id, relevant.get('Name', "")))
+    
+    # Primera pasada: decidir qué instancias iniciar y cuáles detener,
+    # evaluando el horario una sola vez por grupo
+    to_start: List[InstanceInfo] = []
+    to_stop: List[InstanceInfo] = []
+    
+    for config, members in groups.items():
+        # Hora actual en la zona horaria configurada
+        now = local_now.get(config.timezone)
+        if now is None:
+            now = local_now[config.timezone] = now_utc.astimezone(_zi(config.timezone))
         
         if DEBUG:
-            logger.info(f"Evaluando instancia {instance_id} - Config: start={config.start_time}, stop={config.stop_time}, days={config.days}, tz={config.timezone}")
+            logger.info(f"Evaluando {len(members)} instancia(s) - Config: start={config.start_time}, stop={config.stop_time}, days={config.days}, tz={config.timezone}")
             logger.info(f"  Hora actual ({config.timezone}): {now.strftime('%Y-%m-%d %H:%M')}")
         
-        # Verificar si es hora de iniciar
-        if should_perform_action(config, InstanceAction.START, now):
-            if execute_instance_action(instance, InstanceAction.START):
-                stats["started"].append(instance_id)
+        do_start = should_perform_action(config, InstanceAction.START, now)
+        do_stop = should_perform_action(config, InstanceAction.STOP, now)
+        
+        # Sin consultar el estado no se puede elegir entre ambas acciones, y
+        # lanzarlas a la vez dejaría la instancia en un estado arbitrario
+        if do_start and do_stop:
+            logger.warning(
+                f"Horario de inicio y parada coinciden a las {now.strftime('%H:%M')} "
+                f"(start={config.start_time or config.legacy_start_cron}, "
+                f"stop={config.stop_time or config.legacy_stop_cron}); "
+                f"se omiten: {', '.join(m.display_name for m in members)}"
+            )
+            continue
         
-        # Verificar si es hora de detener
-        if should_perform_action(config, InstanceAction.STOP, now):
-            if execute_instance_action(instance, InstanceAction.STOP):
-                stats["stopped"].append(instance_id)
+        if do_start:
+            to_start.extend(members)
+        if do_stop:
+            to_stop.extend(members)
+    
+    # Segunda pasada: acciones en lote
+    jobs = []
+    for action, instances, stats_key in (
+        (InstanceAction.START, to_start, "started"),
+        (InstanceAction.STOP, to_stop, "stopped"),
+    ):
+        for i in range(0, len(instances), ACTION_BATCH_SIZE):
+            jobs.append((action, instances[i:i + ACTION_BATCH_SIZE], stats_key))
+    
+    if not jobs:
+        return stats
+    
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(jobs))) as executor:
+        results = list(executor.map(
+            lambda job: execute_batch_action(ec2_client, job[0], job[1]),
+            jobs,
+        ))
+    
+    # Agregar resultados una vez terminados todos los hilos
+    for (_, _, stats_key), (done, errors) in zip(jobs, results):
+        stats[stats_key].extend(done)
+        stats["errors"].extend(errors)
     
     return stats
 
 
+# Sesión y clientes reutilizados entre invocaciones del mismo contenedor Lambda
+_SESSION = None
+_EC2_CLIENT = None
+_TAGGING_CLIENT = None
+
+
+def _get_session():
+    """Devuelve la sesión boto3 del módulo, creándola en la primera llamada."""
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = boto3.Session()
+    return _SESSION
+
+
+def _get_ec2_client():
+    """Devuelve el cliente EC2 cacheado a nivel de módulo."""
+    global _EC2_CLIENT
+    if _EC2_CLIENT is None:
+        _EC2_CLIENT = _get_session().client('ec2')
+    return _EC2_CLIENT
+
+
+def _get_tagging_client():
+    """Devuelve el cliente de la API de tagging cacheado a nivel de módulo."""
+    global _TAGGING_CLIENT
+    if _TAGGING_CLIENT is None:
+        _TAGGING_CLIENT = _get_session().client('resourcegroupstaggingapi')
+    return _TAGGING_CLIENT
+
+
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Handler principal de AWS Lambda.
@@ -452,22 +822,21 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     start_time = datetime.now(timezone.utc)
     
     try:
-        # Crear sesión y recurso EC2
-        session = boto3.Session()
-        ec2 = session.resource('ec2')
-        
-        # Procesar instancias
-        stats = process_instances(ec2)
+        # Procesar instancias (clientes reutilizados en invocaciones en caliente).
+        # Se reutiliza el instante de inicio como referencia UTC de la ejecución
+        stats = process_instances(_get_ec2_client(), _get_tagging_client(), start_time)
         
         # Log de resultados
         logger.info("-" * 40)
-        logger.info(f"Instancias totales: {stats['total_instances']}")
+        logger.info(f"Instancias candidatas: {stats['total_instances']}")
         logger.info(f"Instancias con schedule: {stats['scheduled_instances']}")
         
         if stats['started']:
             logger.info(f"Instancias iniciadas: {', '.join(stats['started'])}")
         if stats['stopped']:
             logger.info(f"Instancias detenidas: {', '.join(stats['stopped'])}")
+        if stats['errors']:
+            logger.info(f"Errores: {len(stats['errors'])}")
         
         execution_time = (datetime.now(timezone.utc) - start_time).total_seconds()
         logger.info(f"Tiempo de ejecución: {execution_time:.2f}s")
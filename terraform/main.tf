@@ -88,10 +88,9 @@ resource "aws_iam_role_policy" "lambda_policy" {
         Sid    = "EC2InstanceControl"
         Effect = "Allow"
         Action = [
-          "ec2:DescribeInstances",
-          "ec2:DescribeTags",
           "ec2:StartInstances",
-          "ec2:StopInstances"
+          "ec2:StopInstances",
+          "tag:GetResources"
         ]
         Resource = "*"
       },
@@ -6,7 +6,8 @@ Ejecutar con: python -m pytest tests/ -v
 """
 
 import pytest
-from datetime import datetime
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
 from unittest.mock import Mock, MagicMock, patch
 import sys
 import os
@@ -14,12 +15,22 @@ import os
 # Añadir el directorio raíz al path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import EC2StopStart
 from EC2StopStart import (
     CronMatcher,
     TimeParser,
+    _parse_cron_field,
+    _relevant_tags,
+    _zi,
     ScheduleConfig,
     extract_schedule_config,
+    get_current_time,
     should_perform_action,
+    process_instances,
+    discover_scheduled_instances,
+    execute_batch_action,
+    lambda_handler,
+    InstanceInfo,
     InstanceAction,
 )
 
@@ -66,6 +77,27 @@ class TestCronMatcher:
         assert CronMatcher.match_unit(8, "abc") is False
         assert CronMatcher.match_unit(8, "8-") is False
         assert CronMatcher.match_unit(8, "-8") is False
+        assert CronMatcher.match_unit(8, "1-5,8") is False
+        assert CronMatcher.match_unit(8, "1-5-8") is False
+        assert CronMatcher.match_unit(8, "1,,8") is False
+    
+    def test_parse_cron_field_bitmask(self):
+        """Los campos cron se parsean a una máscara de bits (bit i = unidad i)."""
+        assert _parse_cron_field("*") == -1
+        assert _parse_cron_field("08") == 1 << 8
+        assert _parse_cron_field("1-5") == 0b111110
+        assert _parse_cron_field("1,3,5") == 0b101010
+        assert _parse_cron_field("5-1") == 0
+        assert _parse_cron_field("") is None
+        assert _parse_cron_field("1-") is None
+    
+    def test_match_out_of_range_values(self):
+        """Valores fuera de cualquier unidad cron no coinciden (ni reservan memoria)."""
+        assert CronMatcher.match_unit(8, "1000000000") is False
+        assert CronMatcher.match_unit(8, "0-1000000000") is True
+        assert CronMatcher.match_unit(8, "8,1000000000") is True
+        assert CronMatcher.match_unit(-1, "*") is True
+        assert CronMatcher.match_unit(-1, "0-5") is False
     
     def test_is_time_match_full_cron(self):
         """Expresión cron completa debe evaluarse correctamente."""
@@ -76,6 +108,37 @@ class TestCronMatcher:
         assert CronMatcher.is_time_match("0 8 * * 1-5", test_time) is True
         assert CronMatcher.is_time_match("0 9 * * 1", test_time) is False
         assert CronMatcher.is_time_match("0 8 * * 6", test_time) is False  # Sábado
+        assert CronMatcher.is_time_match("0 8 * *", test_time) is False  # 4 campos
+        assert CronMatcher.is_time_match("0 x * * *", test_time) is False
+    
+    def test_is_time_match_short_circuits(self):
+        """Si el minuto no coincide no se evalúan el resto de campos ni se construye el matcher."""
+        test_time = datetime(2026, 1, 19, 8, 15)
+        
+        with patch.object(CronMatcher, "match_unit", wraps=CronMatcher.match_unit) as mock_match, \
+                patch.object(CronMatcher, "build_matcher") as mock_build:
+            assert CronMatcher.is_time_match("0 8 * * 1-5", test_time) is False
+        
+        mock_match.assert_called_once_with(15, "0")
+        mock_build.assert_not_called()
+    
+    def test_built_matcher_short_circuits(self):
+        """El matcher construido tampoco evalúa más campos si el minuto no coincide."""
+        now = Mock(minute=15, hour=8, day=19, month=1)
+        
+        assert CronMatcher.build_matcher("0 8 * * 1-5")(now) is False
+        
+        now.isoweekday.assert_not_called()
+    
+    def test_no_regex_compilation_at_call_time(self):
+        """Las expresiones regulares solo deben compilarse al importar el módulo."""
+        test_time = datetime(2026, 1, 19, 8, 0)
+        
+        with patch("re.compile", side_effect=AssertionError("re.compile en ejecución")):
+            assert CronMatcher.match_unit(3, "1-5") is True
+            assert CronMatcher.is_time_match("0 8 * * 1-5", test_time) is True
+            assert TimeParser.parse_simple_time("08:00") == (8, 0)
+            assert TimeParser.is_simple_time_match("08:00", test_time, "1-5") is True
 
 
 class TestTimeParser:
@@ -109,6 +172,59 @@ class TestTimeParser:
         assert TimeParser.is_simple_time_match("08:00", test_time, "1-5") is True
         assert TimeParser.is_simple_time_match("09:00", test_time, "*") is False
         assert TimeParser.is_simple_time_match("08:00", test_time, "6-7") is False
+    
+    def test_is_simple_time_match_edge_cases(self):
+        """Formatos inválidos o con espacios se validan igual que parse_simple_time."""
+        test_time = datetime(2026, 1, 19, 8, 0)  # Lunes 8:00
+        
+        assert TimeParser.is_simple_time_match("8:00", test_time) is True
+        assert TimeParser.is_simple_time_match(" 08:00 ", test_time) is True
+        assert TimeParser.is_simple_time_match("08:60", test_time) is False
+        assert TimeParser.is_simple_time_match("08:0a", test_time) is False
+        assert TimeParser.is_simple_time_match("8:0:0", test_time) is False
+        assert TimeParser.is_simple_time_match("invalid", test_time) is False
+    
+    def test_is_simple_time_match_checks_hour_before_parsing(self):
+        """Si la hora no coincide no se parsea el tiempo ni los días."""
+        test_time = datetime(2026, 1, 19, 9, 0)
+        
+        with patch.object(TimeParser, "parse_simple_time") as mock_parse, \
+                patch("EC2StopStart._parse_cron_field") as mock_field:
+            assert TimeParser.is_simple_time_match("08:00", test_time, "1-5") is False
+        
+        mock_parse.assert_not_called()
+        mock_field.assert_not_called()
+
+
+class TestCurrentTime:
+    """Tests para la obtención de la hora actual por zona horaria."""
+    
+    def test_uses_iana_timezone(self):
+        """La hora se devuelve en la zona IANA solicitada."""
+        now = get_current_time("Europe/Madrid")
+        
+        assert now.tzinfo.key == "Europe/Madrid"
+    
+    def test_daylight_saving_time(self):
+        """El horario de verano se respeta (Madrid: UTC+1 en invierno, UTC+2 en verano)."""
+        madrid = get_current_time("Europe/Madrid").tzinfo
+        
+        winter = datetime(2026, 1, 19, 7, 0, tzinfo=timezone.utc).astimezone(madrid)
+        summer = datetime(2026, 7, 20, 6, 0, tzinfo=timezone.utc).astimezone(madrid)
+        
+        assert winter.hour == 8
+        assert summer.hour == 8
+    
+    def test_unknown_timezone_falls_back_to_utc(self):
+        """Una zona horaria desconocida usa UTC."""
+        assert get_current_time("Mars/Olympus_Mons").tzinfo is timezone.utc
+    
+    def test_directory_timezone_falls_back_to_utc(self):
+        """Una clave que es un directorio de tzdata (ej: "Europe") usa UTC."""
+        _zi.cache_clear()
+        with patch("EC2StopStart.ZoneInfo", side_effect=IsADirectoryError(21, "Is a directory")):
+            assert get_current_time("Europe").tzinfo is timezone.utc
+        _zi.cache_clear()
 
 
 class TestScheduleConfig:
@@ -116,8 +232,7 @@ class TestScheduleConfig:
     
     def test_extract_new_format(self):
         """Extraer configuración con formato nuevo."""
-        mock_instance = Mock()
-        mock_instance.tags = [
+        tags = [
             {"Key": "AutoSchedule", "Value": "enabled"},
             {"Key": "AutoScheduleStart", "Value": "08:00"},
             {"Key": "AutoScheduleStop", "Value": "18:00"},
@@ -125,7 +240,7 @@ class TestScheduleConfig:
             {"Key": "Timezone", "Value": "Europe/Madrid"},
         ]
         
-        config = extract_schedule_config(mock_instance)
+        config = extract_schedule_config(tags)
         
         assert config.enabled is True
         assert config.start_time == "08:00"
@@ -135,24 +250,54 @@ class TestScheduleConfig:
     
     def test_extract_legacy_format(self):
         """Extraer configuración con formato legacy."""
-        mock_instance = Mock()
-        mock_instance.tags = [
+        tags = [
             {"Key": "startInstance", "Value": "0 8 * * 1-5"},
             {"Key": "stopInstance", "Value": "0 18 * * 1-5"},
         ]
         
-        config = extract_schedule_config(mock_instance)
+        config = extract_schedule_config(tags)
         
         assert config.enabled is True  # Se habilita automáticamente con tags legacy
         assert config.legacy_start_cron == "0 8 * * 1-5"
         assert config.legacy_stop_cron == "0 18 * * 1-5"
     
+    def test_identical_tags_share_config(self):
+        """Instancias con las mismas tags de schedule comparten la configuración."""
+        tags = [
+            {"Key": "Name", "Value": "dev-1"},
+            {"Key": "AutoSchedule", "Value": "enabled"},
+            {"Key": "AutoScheduleStart", "Value": "08:00"},
+        ]
+        other_tags = [dict(tag) for tag in tags]
+        other_tags[0]["Value"] = "dev-2"
+        
+        config = extract_schedule_config(tags)
+        
+        assert extract_schedule_config(other_tags) is config
+        with pytest.raises(AttributeError):
+            config.enabled = False
+        assert not hasattr(config, "__dict__")
+    
+    def test_relevant_tags_single_pass(self):
+        """Solo se conservan las tags de schedule y Name."""
+        tags = [
+            {"Key": "Name", "Value": "dev-1"},
+            {"Key": "Owner", "Value": "equipo-datos"},
+            {"Key": "CostCenter", "Value": "1234"},
+            {"Key": "AutoSchedule", "Value": "enabled"},
+            {"Key": "AutoScheduleDays", "Value": "1-5"},
+        ]
+        
+        assert _relevant_tags(tags) == {
+            "Name": "dev-1",
+            "AutoSchedule": "enabled",
+            "AutoScheduleDays": "1-5",
+        }
+        assert _relevant_tags(None) == {}
+    
     def test_extract_no_tags(self):
         """Instancia sin tags debe retornar config deshabilitada."""
-        mock_instance = Mock()
-        mock_instance.tags = None
-        
-        config = extract_schedule_config(mock_instance)
+        config = extract_schedule_config(None)
         
         assert config.enabled is False
 
@@ -202,6 +347,258 @@ class TestShouldPerformAction:
         # Sábado 8:00
         test_time = datetime(2026, 1, 24, 8, 0)
         assert should_perform_action(config, InstanceAction.START, test_time) is False
+    
+    def test_legacy_fallback(self):
+        """Sin horario nuevo se usan las expresiones cron legacy."""
+        config = ScheduleConfig(enabled=True, legacy_stop_cron="0 18 * * 1-5")
+        
+        test_time = datetime(2026, 1, 19, 18, 0)  # Lunes 18:00
+        assert should_perform_action(config, InstanceAction.STOP, test_time) is True
+        assert should_perform_action(config, InstanceAction.START, test_time) is False
+
+
+class TestProcessInstances:
+    """Tests para el descubrimiento y procesamiento de instancias."""
+    
+    @staticmethod
+    def _tagging_client(pages_by_key):
+        """Crea un cliente de tagging simulado con páginas por clave de tag."""
+        client = MagicMock()
+        paginator = client.get_paginator.return_value
+        paginator.paginate.side_effect = (
+            lambda TagFilters, **kwargs: pages_by_key.get(TagFilters[0]["Key"], [])
+        )
+        return client
+    
+    def test_discover_merges_tag_queries(self):
+        """Cada clave de schedule se consulta aparte y se combinan por ID."""
+        arn = "arn:aws:ec2:eu-west-1:123456789012:instance/"
+        tagging = self._tagging_client({
+            "AutoSchedule": [{"ResourceTagMappingList": [
+                {"ResourceARN": arn + "i-new", "Tags": [{"Key": "AutoSchedule", "Value": "enabled"}]},
+            ]}],
+            "startInstance": [{"ResourceTagMappingList": [
+                {"ResourceARN": arn + "i-legacy", "Tags": [{"Key": "startInstance", "Value": "0 8 * * *"}]},
+            ]}],
+            "stopInstance": [{"ResourceTagMappingList": [
+                {"ResourceARN": arn + "i-legacy", "Tags": [{"Key": "startInstance", "Value": "0 8 * * *"}]},
+            ]}],
+        })
+        
+        instances = discover_scheduled_instances(tagging)
+        
+        assert sorted(instances) == ["i-legacy", "i-new"]
+        assert tagging.get_paginator.return_value.paginate.call_count == 3
+    
+    def test_acts_only_on_matching_instances(self):
+        """Solo actúan las instancias que coinciden con el horario, sin DescribeInstances."""
+        now_utc = datetime(2026, 1, 19, 8, 0, tzinfo=timezone.utc)  # Lunes 8:00
+        arn = "arn:aws:ec2:eu-west-1:123456789012:instance/"
+        tagging = self._tagging_client({
+            "AutoSchedule": [{"ResourceTagMappingList": [
+                {"ResourceARN": arn + "i-start", "Tags": [
+                    {"Key": "AutoSchedule", "Value": "enabled"},
+                    {"Key": "AutoScheduleStart", "Value": "08:00"},
+                ]},
+                {"ResourceARN": arn + "i-idle", "Tags": [
+                    {"Key": "AutoSchedule", "Value": "enabled"},
+                    {"Key": "AutoScheduleStart", "Value": "09:00"},
+                ]},
+                {"ResourceARN": arn + "i-off", "Tags": [
+                    {"Key": "AutoSchedule", "Value": "disabled"},
+                ]},
+            ]}],
+        })
+        ec2_client = MagicMock()
+        ec2_client.start_instances.return_value = {
+            "StartingInstances": [{"InstanceId": "i-start", "PreviousState": {"Name": "stopped"}}],
+        }
+        
+        stats = process_instances(ec2_client, tagging, now_utc)
+        
+        ec2_client.get_paginator.assert_not_called()
+        ec2_client.start_instances.assert_called_once_with(InstanceIds=["i-start"])
+        ec2_client.stop_instances.assert_not_called()
+        assert stats["total_instances"] == 3
+        assert stats["scheduled_instances"] == 2
+        assert stats["started"] == ["i-start"]
+    
+    @patch("EC2StopStart.should_perform_action", wraps=should_perform_action)
+    def test_schedule_evaluated_once_per_config(self, mock_should):
+        """Instancias con la misma configuración se evalúan una sola vez."""
+        arn = "arn:aws:ec2:eu-west-1:123456789012:instance/"
+        tags = [
+            {"Key": "AutoSchedule", "Value": "enabled"},
+            {"Key": "AutoScheduleStart", "Value": "08:00"},
+        ]
+        tagging = self._tagging_client({"AutoSchedule": [{"ResourceTagMappingList": [
+            {"ResourceARN": f"{arn}i-{n}", "Tags": tags} for n in range(50)
+        ]}]})
+        now_utc = datetime(2026, 1, 19, 9, 0, tzinfo=timezone.utc)
+        
+        stats = process_instances(MagicMock(), tagging, now_utc)
+        
+        assert stats["scheduled_instances"] == 50
+        assert mock_should.call_count == 2  # START y STOP, una vez por grupo
+    
+    def test_overlapping_start_and_stop_skipped(self):
+        """Si inicio y parada coinciden en la misma ejecución no se lanza ninguna acción."""
+        now_utc = datetime(2026, 1, 19, 8, 15, tzinfo=timezone.utc)  # Lunes 8:15
+        arn = "arn:aws:ec2:eu-west-1:123456789012:instance/"
+        tagging = self._tagging_client({"AutoSchedule": [{"ResourceTagMappingList": [
+            {"ResourceARN": arn + "i-1", "Tags": [
+                {"Key": "AutoSchedule", "Value": "enabled"},
+                {"Key": "AutoScheduleStart", "Value": "08:00"},
+                {"Key": "AutoScheduleStop", "Value": "08:30"},
+            ]},
+        ]}]})
+        ec2_client = MagicMock()
+        
+        stats = process_instances(ec2_client, tagging, now_utc)
+        
+        ec2_client.start_instances.assert_not_called()
+        ec2_client.stop_instances.assert_not_called()
+        assert stats["scheduled_instances"] == 1
+        assert stats["started"] == []
+        assert stats["stopped"] == []
+    
+    def test_no_api_calls_when_nothing_to_do(self):
+        """Sin acciones pendientes no se llama a la API de EC2."""
+        tagging = self._tagging_client({})
+        ec2_client = MagicMock()
+        
+        stats = process_instances(ec2_client, tagging)
+        
+        assert ec2_client.method_calls == []
+        assert stats["total_instances"] == 0
+    
+    def test_start_and_stop_batches_aggregated(self):
+        """Los lotes de inicio y parada se ejecutan y sus resultados se agregan."""
+        now_utc = datetime(2026, 1, 19, 8, 0, tzinfo=timezone.utc)  # Lunes 8:00
+        arn = "arn:aws:ec2:eu-west-1:123456789012:instance/"
+        mappings = [
+            {"ResourceARN": f"{arn}i-start{n}", "Tags": [{"Key": "startInstance", "Value": "0 8 * * *"}]}
+            for n in range(300)
+        ] + [
+            {"ResourceARN": f"{arn}i-stop{n}", "Tags": [{"Key": "stopInstance", "Value": "0 8 * * *"}]}
+            for n in range(3)
+        ]
+        tagging = self._tagging_client({"startInstance": [{"ResourceTagMappingList": mappings}]})
+        ec2_client = MagicMock()
+        ec2_client.start_instances.side_effect = lambda InstanceIds: {"StartingInstances": [
+            {"InstanceId": i, "PreviousState": {"Name": "stopped"}} for i in InstanceIds
+        ]}
+        ec2_client.stop_instances.side_effect = lambda InstanceIds: {"StoppingInstances": [
+            {"InstanceId": i, "PreviousState": {"Name": "running"}} for i in InstanceIds
+        ]}
+        
+        stats = process_instances(ec2_client, tagging, now_utc)
+        
+        assert ec2_client.start_instances.call_count == 2
+        assert ec2_client.stop_instances.call_count == 1
+        assert stats["started"] == [f"i-start{n}" for n in range(300)]
+        assert stats["stopped"] == ["i-stop0", "i-stop1", "i-stop2"]
+        assert stats["errors"] == []
+    
+    def test_batch_action_isolates_failing_instance(self):
+        """Un lote fallido se reintenta instancia a instancia y se aísla el error."""
+        instance_ids = [f"i-{n:03d}" for n in range(50)]
+        instances = [InstanceInfo(instance_id, f"web-{instance_id}") for instance_id in instance_ids]
+        
+        def stop_instances(InstanceIds):
+            if "i-021" in InstanceIds:
+                raise ClientError({"Error": {"Code": "IncorrectInstanceState", "Message": "x"}}, "StopInstances")
+            return {"StoppingInstances": [
+                {"InstanceId": i, "PreviousState": {"Name": "running"}} for i in InstanceIds
+            ]}
+        
+        ec2_client = MagicMock()
+        ec2_client.stop_instances.side_effect = stop_instances
+        
+        done, errors = execute_batch_action(ec2_client, InstanceAction.STOP, instances)
+        
+        # 1 lote + 2 llamadas por nivel de bisección (log2(50) ≈ 6 niveles)
+        assert ec2_client.stop_instances.call_count <= 1 + 2 * 6
+        assert sorted(done) == [i for i in instance_ids if i != "i-021"]
+        assert errors == [{"instance_id": "i-021", "action": "stop", "error": errors[0]["error"]}]
+    
+    def test_batch_action_bisection_call_count(self):
+        """Un lote completo con una instancia terminada no se reintenta una a una."""
+        instances = [InstanceInfo(f"i-{n:03d}") for n in range(200)]
+        
+        def start_instances(InstanceIds):
+            if "i-137" in InstanceIds:
+                raise ClientError({"Error": {"Code": "IncorrectInstanceState", "Message": "x"}}, "StartInstances")
+            return {"StartingInstances": [
+                {"InstanceId": i, "PreviousState": {"Name": "stopped"}} for i in InstanceIds
+            ]}
+        
+        ec2_client = MagicMock()
+        ec2_client.start_instances.side_effect = start_instances
+        
+        done, errors = execute_batch_action(ec2_client, InstanceAction.START, instances)
+        
+        # 1 lote + como mucho 2 llamadas por cada uno de los 8 niveles (200 -> 1)
+        assert ec2_client.start_instances.call_count <= 1 + 2 * 8
+        assert len(done) == 199
+        assert [e["instance_id"] for e in errors] == ["i-137"]
+    
+    def test_batch_action_throttling_does_not_fan_out(self):
+        """Errores no atribuibles a una instancia fallan el lote sin reintentos individuales."""
+        instances = [InstanceInfo(f"i-{n}") for n in range(5)]
+        ec2_client = MagicMock()
+        ec2_client.start_instances.side_effect = ClientError(
+            {"Error": {"Code": "RequestLimitExceeded", "Message": "x"}}, "StartInstances",
+        )
+        
+        done, errors = execute_batch_action(ec2_client, InstanceAction.START, instances)
+        
+        ec2_client.start_instances.assert_called_once()
+        assert done == []
+        assert [e["instance_id"] for e in errors] == [f"i-{n}" for n in range(5)]
+    
+    def test_batch_action_skips_instances_already_in_state(self):
+        """Las instancias que ya estaban en el estado destino no cuentan como iniciadas."""
+        ec2_client = MagicMock()
+        ec2_client.start_instances.return_value = {"StartingInstances": [
+            {"InstanceId": "i-1", "PreviousState": {"Name": "stopped"}},
+            {"InstanceId": "i-2", "PreviousState": {"Name": "running"}},
+        ]}
+        
+        done, errors = execute_batch_action(
+            ec2_client, InstanceAction.START, [InstanceInfo("i-1", "web"), InstanceInfo("i-2")],
+        )
+        
+        assert done == ["i-1"]
+        assert errors == []
+    
+    def test_instance_display_name(self):
+        """El nombre legible incluye la tag Name cuando existe."""
+        assert InstanceInfo("i-1", "web").display_name == "web (i-1)"
+        assert InstanceInfo("i-1").display_name == "i-1"
+
+
+class TestLambdaHandler:
+    """Tests para el handler de Lambda."""
+    
+    @patch("EC2StopStart.process_instances")
+    @patch("EC2StopStart.boto3.Session")
+    def test_clients_reused_across_invocations(self, mock_session, mock_process):
+        """La sesión y los clientes se crean una vez y se reutilizan en caliente."""
+        mock_process.return_value = {
+            "total_instances": 0, "scheduled_instances": 0,
+            "started": [], "stopped": [], "errors": [],
+        }
+        
+        with patch.multiple(EC2StopStart, _SESSION=None, _EC2_CLIENT=None, _TAGGING_CLIENT=None):
+            assert lambda_handler({}, None)["statusCode"] == 200
+            assert lambda_handler({}, None)["statusCode"] == 200
+        
+        mock_session.assert_called_once_with()
+        assert mock_session.return_value.client.call_count == 2
+        first_call, second_call = mock_process.call_args_list
+        assert first_call.args[:2] == second_call.args[:2]
+        assert first_call.args[2].tzinfo is timezone.utc
 
 
 if __name__ == "__main__":